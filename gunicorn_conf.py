@@ -0,0 +1,18 @@
+"""
+Gunicorn settings for TinyMedia
+
+Run with: gunicorn -c gunicorn_conf.py server:app
+"""
+
+bind = '0.0.0.0:5000'
+
+# Streams and uploads are long-lived and I/O-bound: a few processes with
+# many threads each keep one slow client from blocking the others
+workers = 2
+worker_class = 'gthread'
+threads = 32
+
+# Phones reconnect for every range request while seeking; keep the
+# connection open between them. Idle keep-alive sockets wait in the
+# worker's poller and do not tie up a thread.
+keepalive = 75
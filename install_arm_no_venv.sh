@@ -338,6 +338,9 @@ if python3 -m pip install --help 2>&1 | grep -q -- '--break-system-packages'; th
 fi
 python3 -m pip install --upgrade --user $PIP_BRK pip
 python3 -m pip install --user $PIP_BRK Flask gunicorn
+# Optional faster JSON encoder; the server falls back to stdlib json without it
+python3 -m pip install --user $PIP_BRK --only-binary=:all: orjson \
+  || echo "Warning: no orjson wheel for this board, using stdlib json." >&2
 
 # Resolve gunicorn binary from the pip user-install location
 GUNICORN_BIN="$(python3 -m site --user-base)/bin/gunicorn"
@@ -347,6 +350,20 @@ if [ ! -x "$GUNICORN_BIN" ]; then
 fi
 echo "Gunicorn binary: $GUNICORN_BIN"
 
+# Compile templates now so the first page view after boot doesn't pay for it
+JINJA_CACHE_DIR="$HOME/.cache/tinymedia/jinja"
+echo "Precompiling templates into $JINJA_CACHE_DIR..."
+if ! (cd "$REPO_DIR" && MEDIA_ROOT="$MEDIA_ROOT" JINJA_CACHE_DIR="$JINJA_CACHE_DIR" python3 -c \
+    'from server import app; [app.jinja_env.get_template(t) for t in ("index.html", "error.html")]'); then
+  echo "Warning: template precompilation failed; templates will compile on first use." >&2
+fi
+
+# FAT/exFAT can't hold symlinks, so the server may skip resolving them
+TRUST_SYMLINKS=0
+if [[ "${DEV_FSTYPE:-}" == "vfat" || "${DEV_FSTYPE:-}" == "exfat" ]]; then
+  TRUST_SYMLINKS=1
+fi
+
 SERVICE_FILE="/etc/systemd/system/tinymedia.service"
 echo "Writing systemd service to $SERVICE_FILE (requires sudo)..."
 
@@ -363,10 +380,12 @@ Requires=${MEDIA_ROOT_ESCAPED}.mount
 Type=simple
 User=$USER_NAME
 Environment=MEDIA_ROOT=$MEDIA_ROOT
+Environment=JINJA_CACHE_DIR=$JINJA_CACHE_DIR
+Environment=TRUST_SYMLINKS=$TRUST_SYMLINKS
 WorkingDirectory=$REPO_DIR
 ExecStartPre=/bin/sleep 2
 ExecStartPre=/bin/sh -c 'until mountpoint -q $MEDIA_ROOT; do echo Waiting for $MEDIA_ROOT...; sleep 2; done'
-ExecStart=$GUNICORN_BIN -w 2 -b 0.0.0.0:5000 server:app
+ExecStart=$GUNICORN_BIN -c $REPO_DIR/gunicorn_conf.py server:app
 Restart=on-failure
 RestartSec=10
 
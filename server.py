@@ -12,15 +12,74 @@ from flask import (
     Flask, render_template, send_file, request, 
     redirect, url_for, jsonify, abort
 )
+from jinja2 import FileSystemBytecodeCache
 from pathlib import Path
-from functools import wraps
+from collections import namedtuple
+from functools import wraps, lru_cache
+from typing import Optional
+from stat import S_ISDIR
+from tempfile import SpooledTemporaryFile
+from urllib.parse import quote
 import os
 import mimetypes
+import re
+import shutil
+import time
+import unicodedata
+
+try:
+    import orjson
+except ImportError:  # No wheels for some older ARM boards; use stdlib json
+    orjson = None
 
 app = Flask(__name__)
 
 # Configuration
 MEDIA_ROOT = Path(os.environ.get('MEDIA_ROOT', '/media/usb'))
+MEDIA_ROOT_RESOLVED = MEDIA_ROOT.resolve()
+# Every served path must equal the root or start with this prefix
+_MEDIA_ROOT_STR = str(MEDIA_ROOT_RESOLVED)
+_MEDIA_ROOT_PREFIX = os.path.join(_MEDIA_ROOT_STR, '')
+
+# Skip resolving symlinks in requested paths. Only safe when MEDIA_ROOT
+# holds no symlinks pointing outside it (always true on FAT/exFAT).
+TRUST_SYMLINKS = os.environ.get('TRUST_SYMLINKS') == '1'
+
+# Behind Apache (mod_xsendfile) or lighttpd, let the proxy send file bodies
+# with the kernel's sendfile instead of copying them through Python
+app.config['USE_X_SENDFILE'] = os.environ.get('USE_X_SENDFILE') == '1'
+
+# Behind nginx, hand file responses to an internal location that serves
+# MEDIA_ROOT (e.g. X_ACCEL_PREFIX=/internal_media/)
+X_ACCEL_PREFIX = os.environ.get('X_ACCEL_PREFIX', '')
+
+# Keep compiled templates across restarts (the installer sets this)
+JINJA_CACHE_DIR = os.environ.get('JINJA_CACHE_DIR')
+if JINJA_CACHE_DIR:
+    os.makedirs(JINJA_CACHE_DIR, exist_ok=True)
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(JINJA_CACHE_DIR)
+
+# System folders to hide (common Windows/system folders)
+HIDDEN_NAMES = frozenset({
+    'System Volume Information', '$RECYCLE.BIN', 'Thumbs.db', '.Trashes', '.Spotlight-V100'
+})
+
+# Anything but letters, digits, space, '-' and '_' is stripped from folder names
+FOLDER_NAME_DISALLOWED = re.compile(r'[^\w \-]')
+
+# Buffer size for writing uploads that are still held in memory
+UPLOAD_CHUNK_SIZE = 1 << 20
+
+# Seconds a folder listing or storage reading may be served from cache
+CACHE_TTL = 5.0
+
+# Folders modified more recently than this are never cached: FAT stores
+# mtimes in 2 s steps, so a change landing in the same step would go
+# unnoticed by workers that didn't see the write themselves
+RACY_MTIME_NS = 2_000_000_000
+
+# media-relative folder path -> (folder mtime_ns, cached at, items)
+_dir_cache = {}
 
 # Ensure mimetypes are properly registered
 mimetypes.add_type('video/mp4', '.mp4')
@@ -32,72 +91,93 @@ mimetypes.add_type('audio/flac', '.flac')
 mimetypes.add_type('application/vnd.android.package-archive', '.apk')
 
 
+@lru_cache(maxsize=4096)
+def _guess_mime(suffix: str) -> Optional[str]:
+    """MIME type for a lowercased file extension such as '.mp4'"""
+    return mimetypes.types_map.get(suffix) or mimetypes.guess_type('x' + suffix)[0]
+
+
+def guess_mime(name: str) -> Optional[str]:
+    """Guess MIME type from a filename's extension"""
+    return _guess_mime(os.path.splitext(name)[1].lower())
+
+
 def safe_path(func):
     """Decorator to validate paths and prevent directory traversal"""
     @wraps(func)
     def wrapper(subpath=''):
-        # Normalize and resolve path
+        # Normalize path; collapsing '..' this way needs no syscalls
         subpath = subpath.strip('/')
-        full_path = (MEDIA_ROOT / subpath).resolve()
+        full_path_str = os.path.normpath(os.path.join(_MEDIA_ROOT_PREFIX, subpath))
+        if not TRUST_SYMLINKS:
+            # Follow symlinks so a link can't lead outside MEDIA_ROOT
+            full_path_str = os.path.realpath(full_path_str)
         
         # Ensure we're still within MEDIA_ROOT
-        try:
-            full_path.relative_to(MEDIA_ROOT.resolve())
-        except ValueError:
+        if not (full_path_str == _MEDIA_ROOT_STR
+                or full_path_str.startswith(_MEDIA_ROOT_PREFIX)):
             abort(403)  # Path traversal attempt
         
-        return func(subpath, full_path)
+        return func(subpath, Path(full_path_str))
     return wrapper
 
 
-def get_file_info(path: Path) -> dict:
+# One folder listing row; tuples are much smaller than dicts in big folders
+Item = namedtuple('Item', 'name is_dir size size_human mime type')
+
+
+def get_file_info(entry: os.DirEntry) -> Item:
     """Get file/folder info for display"""
-    stat = path.stat()
-    is_dir = path.is_dir()
+    # The entry type comes from readdir; only files need a stat() for size
+    if entry.is_dir():
+        return Item(entry.name, True, None, None, None, None)
     
-    info = {
-        'name': path.name,
-        'is_dir': is_dir,
-        'size': stat.st_size if not is_dir else None,
-        'size_human': format_size(stat.st_size) if not is_dir else None,
-    }
-    
-    if not is_dir:
-        mime, _ = mimetypes.guess_type(path.name)
-        info['mime'] = mime or 'application/octet-stream'
-        info['type'] = get_file_type(mime)
-    
-    return info
+    size = entry.stat().st_size
+    mime = guess_mime(entry.name)
+    return Item(
+        entry.name, False, size, format_size(size),
+        mime or 'application/octet-stream', get_file_type(mime)
+    )
+
+
+# File categories by exact MIME type, then by its top-level type
+MIME_CATEGORY_EXACT = {'application/pdf': 'document'}
+MIME_CATEGORY_PREFIX = {'video': 'video', 'audio': 'audio', 'image': 'image'}
 
 
 def get_file_type(mime: str) -> str:
     """Categorize file by MIME type"""
     if not mime:
         return 'file'
-    if mime.startswith('video/'):
-        return 'video'
-    if mime.startswith('audio/'):
-        return 'audio'
-    if mime.startswith('image/'):
-        return 'image'
-    if mime in ('application/pdf',):
-        return 'document'
-    return 'file'
+    category = MIME_CATEGORY_EXACT.get(mime)
+    if category:
+        return category
+    top, sep, _ = mime.partition('/')
+    return MIME_CATEGORY_PREFIX.get(top, 'file') if sep else 'file'
+
+
+SIZE_UNITS = ('B', 'KB', 'MB', 'GB', 'TB')
 
 
 def format_size(size: int) -> str:
     """Human-readable file size"""
-    for unit in ['B', 'KB', 'MB', 'GB']:
-        if size < 1024:
-            return f"{size:.1f} {unit}"
-        size /= 1024
-    return f"{size:.1f} TB"
+    if size < 1024:
+        return f"{size:.1f} B"
+    # Each unit is 2**10 of the previous one, so bit_length picks the unit
+    idx = min((int(size).bit_length() - 1) // 10, len(SIZE_UNITS) - 1)
+    return f"{size / (1 << (idx * 10)):.1f} {SIZE_UNITS[idx]}"
+
+
+@lru_cache(maxsize=1)
+def _statvfs_cached(bucket: int) -> os.statvfs_result:
+    """statvfs() of MEDIA_ROOT, computed once per CACHE_TTL time bucket"""
+    return os.statvfs(MEDIA_ROOT)
 
 
 def get_storage_info() -> dict:
     """Get storage usage for MEDIA_ROOT"""
     try:
-        stat = os.statvfs(MEDIA_ROOT)
+        stat = _statvfs_cached(int(time.monotonic() // CACHE_TTL))
         total = stat.f_blocks * stat.f_frsize
         free = stat.f_bavail * stat.f_frsize
         used = total - free
@@ -111,21 +191,118 @@ def get_storage_info() -> dict:
         return None
 
 
+def media_relpath(full_path: Path) -> str:
+    """Normalized path of a checked full_path relative to MEDIA_ROOT"""
+    full_path_str = str(full_path)
+    if full_path_str == _MEDIA_ROOT_STR:
+        return ''
+    return full_path_str[len(_MEDIA_ROOT_PREFIX):]
+
+
+def cache_listing(key: str, entry: tuple) -> None:
+    """Store a folder listing, dropping listings older than CACHE_TTL"""
+    now = time.monotonic()
+    for old_key, old_entry in list(_dir_cache.items()):
+        if now - old_entry[1] >= CACHE_TTL:
+            _dir_cache.pop(old_key, None)
+    _dir_cache[key] = entry
+
+
+def invalidate_caches(full_path: Path) -> None:
+    """Drop cached data made stale by a write to a folder"""
+    _dir_cache.pop(media_relpath(full_path), None)
+    _statvfs_cached.cache_clear()
+
+
+def save_upload(file, dest: Path) -> None:
+    """Write an uploaded file to dest"""
+    src = file.stream
+    with open(dest, 'wb') as out:
+        # Large uploads are spooled to a temp file by Werkzeug; copy those
+        # in the kernel with sendfile() instead of through Python buffers.
+        # fileno() would force an in-memory spool out to disk, so small
+        # uploads skip straight to the buffered copy.
+        on_disk = not isinstance(src, SpooledTemporaryFile) or getattr(src, '_rolled', False)
+        in_fd = None
+        if on_disk:
+            try:
+                in_fd = src.fileno()
+            except (AttributeError, OSError):
+                pass
+        
+        if in_fd is not None and hasattr(os, 'sendfile'):
+            offset = 0
+            remaining = os.fstat(in_fd).st_size
+            try:
+                while remaining > 0:
+                    sent = os.sendfile(out.fileno(), in_fd, offset, remaining)
+                    if sent == 0:
+                        break
+                    offset += sent
+                    remaining -= sent
+                return
+            except OSError:
+                if offset:
+                    raise
+                # sendfile() to regular files is unsupported here; fall back
+        
+        shutil.copyfileobj(src, out, UPLOAD_CHUNK_SIZE)
+
+
+def accel_redirect(full_path: Path, mime: Optional[str] = None, download_name: Optional[str] = None):
+    """Let nginx serve a file from its internal media location"""
+    response = app.response_class(mimetype=mime or 'application/octet-stream')
+    # Point nginx at the checked path, not the raw request path
+    response.headers['X-Accel-Redirect'] = X_ACCEL_PREFIX + quote(media_relpath(full_path))
+    if download_name:
+        # Same Content-Disposition send_file builds: plain ASCII filename,
+        # plus filename* when the real name needs UTF-8
+        try:
+            download_name.encode('ascii')
+        except UnicodeEncodeError:
+            simple = unicodedata.normalize('NFKD', download_name)
+            simple = simple.encode('ascii', 'ignore').decode('ascii')
+            quoted = quote(download_name, safe="!#$&+^`|~")
+            names = {'filename': simple, 'filename*': f"UTF-8''{quoted}"}
+        else:
+            names = {'filename': download_name}
+        response.headers.set('Content-Disposition', 'attachment', **names)
+    return response
+
+
+def json_response(payload: dict, status: int = 200):
+    """JSON response, encoded with orjson when it is installed"""
+    if orjson is None:
+        return jsonify(payload), status
+    return app.response_class(orjson.dumps(payload), status=status, mimetype='application/json')
+
+
 def get_breadcrumbs(subpath: str) -> list:
     """Generate breadcrumb navigation"""
     crumbs = [{'name': 'Home', 'path': ''}]
     
     if subpath:
-        parts = subpath.split('/')
-        for i, part in enumerate(parts):
+        prefix = ''
+        for part in subpath.split('/'):
+            prefix = prefix + '/' + part if prefix else part
             crumbs.append({
                 'name': part,
-                'path': '/'.join(parts[:i+1])
+                'path': prefix
             })
     
     return crumbs
 
 
+def render_folder(subpath: str, items: list):
+    """Render a folder listing page"""
+    return render_template('index.html',
+        items=items,
+        current_path=subpath,
+        breadcrumbs=get_breadcrumbs(subpath),
+        storage=get_storage_info()
+    )
+
+
 @app.route('/')
 def index():
     return redirect(url_for('browse'))
@@ -136,31 +313,44 @@ def index():
 @safe_path
 def browse(subpath, full_path):
     """Browse folder contents"""
-    if not full_path.exists():
+    try:
+        folder_stat = full_path.stat()
+    except OSError:
         abort(404)
     
-    if full_path.is_file():
+    if not S_ISDIR(folder_stat.st_mode):
         # If user navigates to a file, redirect to stream
         return redirect(url_for('stream', subpath=subpath))
     
+    # Reuse a recent listing if nothing was added, removed or renamed since
+    now = time.monotonic()
+    cache_key = media_relpath(full_path)
+    cached = _dir_cache.get(cache_key)
+    if (cached and cached[0] == folder_stat.st_mtime_ns
+            and now - cached[1] < CACHE_TTL):
+        return render_folder(subpath, cached[2])
+    
     # List folder contents
-    items = []
-    # System folders to hide (common Windows/system folders)
-    hidden_folders = {'System Volume Information', '$RECYCLE.BIN', 'Thumbs.db', '.Trashes', '.Spotlight-V100'}
     try:
-        for entry in sorted(full_path.iterdir(), key=lambda x: (not x.is_dir(), x.name.lower())):
-            if entry.name.startswith('.') or entry.name in hidden_folders:
-                continue  # Skip hidden files and system folders
-            items.append(get_file_info(entry))
+        # Skip hidden files and system folders before touching them at all
+        with os.scandir(full_path) as it:
+            entries = [e for e in it
+                       if not e.name.startswith('.') and e.name not in HIDDEN_NAMES]
+        
+        # scandir keeps the entry type from readdir, so splitting folders
+        # from files needs no stat()
+        dirs, files = [], []
+        for entry in entries:
+            (dirs if entry.is_dir() else files).append(entry)
+        dirs.sort(key=lambda e: e.name.lower())
+        files.sort(key=lambda e: e.name.lower())
+        items = [get_file_info(entry) for entry in dirs + files]
     except PermissionError:
         abort(403)
     
-    return render_template('index.html',
-        items=items,
-        current_path=subpath,
-        breadcrumbs=get_breadcrumbs(subpath),
-        storage=get_storage_info()
-    )
+    if abs(time.time_ns() - folder_stat.st_mtime_ns) >= RACY_MTIME_NS:
+        cache_listing(cache_key, (folder_stat.st_mtime_ns, now, items))
+    return render_folder(subpath, items)
 
 
 @app.route('/stream/<path:subpath>')
@@ -170,13 +360,17 @@ def stream(subpath, full_path):
     if not full_path.is_file():
         abort(404)
     
-    mime, _ = mimetypes.guess_type(full_path.name)
+    mime = guess_mime(full_path.name)
+    
+    if X_ACCEL_PREFIX:
+        return accel_redirect(full_path, mime)
     
-    # send_file handles range requests automatically
+    # send_file handles range requests automatically. With X-Sendfile the
+    # front server must see a plain 200 so it applies Range itself.
     return send_file(
         full_path,
         mimetype=mime,
-        conditional=True  # Enables range request support
+        conditional=not app.config['USE_X_SENDFILE']  # Enables range request support
     )
 
 
@@ -187,6 +381,9 @@ def download(subpath, full_path):
     if not full_path.is_file():
         abort(404)
     
+    if X_ACCEL_PREFIX:
+        return accel_redirect(full_path, guess_mime(full_path.name), full_path.name)
+    
     return send_file(
         full_path,
         as_attachment=True,
@@ -200,40 +397,47 @@ def download(subpath, full_path):
 def upload(subpath, full_path):
     """Upload file to folder"""
     if not full_path.is_dir():
-        return jsonify({'error': 'Invalid folder'}), 400
+        return json_response({'error': 'Invalid folder'}, 400)
     
     if 'file' not in request.files:
-        return jsonify({'error': 'No file provided'}), 400
+        return json_response({'error': 'No file provided'}, 400)
     
     file = request.files['file']
     if file.filename == '':
-        return jsonify({'error': 'No file selected'}), 400
+        return json_response({'error': 'No file selected'}, 400)
     
     # Sanitize filename
     filename = Path(file.filename).name  # Remove any path components
     if filename.startswith('.'):
-        return jsonify({'error': 'Hidden files not allowed'}), 400
+        return json_response({'error': 'Hidden files not allowed'}, 400)
     
     dest = full_path / filename
     
     # Don't overwrite existing files - add number suffix
     if dest.exists():
+        # One directory read instead of a stat() per taken candidate name
+        with os.scandir(full_path) as it:
+            existing = {e.name for e in it}
         base = dest.stem
         suffix = dest.suffix
         counter = 1
-        while dest.exists():
+        while True:
             dest = full_path / f"{base}_{counter}{suffix}"
             counter += 1
+            # exists() catches case-insensitive matches (FAT/exFAT) and races
+            if dest.name not in existing and not dest.exists():
+                break
     
     try:
-        file.save(dest)
-        return jsonify({
+        save_upload(file, dest)
+        invalidate_caches(full_path)
+        return json_response({
             'success': True, 
             'filename': dest.name,
             'size': format_size(dest.stat().st_size)
         })
     except OSError as e:
-        return jsonify({'error': str(e)}), 500
+        return json_response({'error': str(e)}, 500)
 
 
 @app.route('/mkdir/<path:subpath>', methods=['POST'])
@@ -242,29 +446,30 @@ def upload(subpath, full_path):
 def mkdir(subpath, full_path):
     """Create new folder"""
     if not full_path.is_dir():
-        return jsonify({'error': 'Invalid parent folder'}), 400
+        return json_response({'error': 'Invalid parent folder'}, 400)
     
     data = request.get_json()
     if not data or 'name' not in data:
-        return jsonify({'error': 'Folder name required'}), 400
+        return json_response({'error': 'Folder name required'}, 400)
     
     # Sanitize folder name
     folder_name = data['name'].strip()
-    folder_name = ''.join(c for c in folder_name if c.isalnum() or c in ' -_').strip()
+    folder_name = FOLDER_NAME_DISALLOWED.sub('', folder_name).strip()
     
     if not folder_name:
-        return jsonify({'error': 'Invalid folder name'}), 400
+        return json_response({'error': 'Invalid folder name'}, 400)
     
     new_folder = full_path / folder_name
     
     if new_folder.exists():
-        return jsonify({'error': 'Folder already exists'}), 400
+        return json_response({'error': 'Folder already exists'}, 400)
     
     try:
         new_folder.mkdir()
-        return jsonify({'success': True, 'name': folder_name})
+        invalidate_caches(full_path)
+        return json_response({'success': True, 'name': folder_name})
     except OSError as e:
-        return jsonify({'error': str(e)}), 500
+        return json_response({'error': str(e)}, 500)
 
 
 @app.errorhandler(404)
@@ -284,5 +489,5 @@ if __name__ == '__main__':
     print(f"Media root: {MEDIA_ROOT}")
     print(f"Starting server on http://0.0.0.0:5000")
     
-    # For production, use: gunicorn -w 2 -b 0.0.0.0:5000 server:app
+    # For production, use: gunicorn -c gunicorn_conf.py server:app
     app.run(host='0.0.0.0', port=5000, debug=False, threaded=True)